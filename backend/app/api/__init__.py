@@ -1,3 +1,4 @@
 from .routes import router
+from .responses import ORJSONResponse
 
-__all__ = ["router"]
+__all__ = ["router", "ORJSONResponse"]
@@ -1,9 +1,12 @@
 import uuid
 import aiofiles
+import anyio
+import orjson
 from pathlib import Path
 from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from .responses import ORJSONResponse
 from ..config import get_settings
 from ..models import (
     UploadResponse,
@@ -22,6 +25,9 @@ settings = get_settings()
 UPLOAD_DIR = Path(settings.upload_dir)
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Read uploads in 1MB chunks so large files never sit fully in memory
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 
 def cleanup_file(file_path: Path):
     """Background task to clean up uploaded files."""
@@ -52,69 +58,74 @@ async def upload_file(
             detail=f"Unsupported file type: {ext}. Allowed: {', '.join(settings.allowed_extensions)}"
         )
     
-    # Check file size
-    content = await file.read()
-    size_mb = len(content) / (1024 * 1024)
-    
-    if size_mb > settings.max_file_size_mb:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large: {size_mb:.1f}MB. Maximum: {settings.max_file_size_mb}MB"
-        )
-    
-    # Generate session ID and save file
+    # Generate session ID and stream file to disk, enforcing the size limit
     session_id = str(uuid.uuid4())
     file_path = UPLOAD_DIR / f"{session_id}{ext}"
+    max_bytes = settings.max_file_size_mb * 1024 * 1024
+    size = 0
     
     try:
         async with aiofiles.open(file_path, "wb") as f:
-            await f.write(content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File too large. Maximum: {settings.max_file_size_mb}MB"
+                    )
+                await f.write(chunk)
         
-        # Detect file type and load data
+        # Detect file type and load data; large files start with a preview
         file_type = DataService.detect_file_type(filename)
-        df = await DataService.load_file(file_path, file_type)
+        df, is_preview = await DataService.load_preview(file_path, file_type)
         
-        # Store in session
-        DataService.store_session(session_id, df, {
-            "filename": filename,
-            "file_type": file_type,
-        })
+        # Store in session and generate profile
+        profile = await anyio.to_thread.run_sync(
+            DataService.store_session,
+            session_id,
+            df,
+            {"filename": filename, "file_type": file_type, "preview": is_preview},
+        )
         
-        # Generate profile
-        profile = DataService.profile_dataframe(df, session_id, filename, file_type)
+        # Remove sessions nobody has used within the retention period
+        background_tasks.add_task(DataService.purge_expired_sessions)
         
-        # Schedule file cleanup
-        background_tasks.add_task(cleanup_file, file_path)
+        if is_preview:
+            # Load the full file after responding; it is removed once loaded
+            DataService.defer_full_load(session_id, file_path, file_type)
+            background_tasks.add_task(DataService.materialize_session, session_id)
+        else:
+            # Schedule file cleanup
+            background_tasks.add_task(cleanup_file, file_path)
         
-        return UploadResponse(
+        # Returning a Response directly skips FastAPI's response_model
+        # re-validation; the model is still used for the OpenAPI schema
+        response = UploadResponse.model_construct(
             success=True,
             session_id=session_id,
             message=f"Successfully loaded {filename}",
             profile=profile,
         )
+        return ORJSONResponse(response.model_dump(mode="json"))
         
+    except HTTPException:
+        cleanup_file(file_path)
+        raise
     except Exception as e:
         # Clean up on error
-        if file_path.exists():
-            file_path.unlink()
+        cleanup_file(file_path)
         raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
 
 
 @router.get("/profile/{session_id}", response_model=DataProfile)
 async def get_profile(session_id: str):
     """Get data profile for a session."""
-    df = DataService.get_session(session_id)
-    metadata = DataService.get_metadata(session_id)
+    profile = DataService.get_profile(session_id)
     
-    if df is None or metadata is None:
+    if profile is None:
         raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
     
-    return DataService.profile_dataframe(
-        df,
-        session_id,
-        metadata["filename"],
-        metadata["file_type"],
-    )
+    return ORJSONResponse(profile.model_dump(mode="json"))
 
 
 @router.post("/query", response_model=QueryResponse)
@@ -124,9 +135,7 @@ async def query_data(request: QueryRequest):
     
     Returns analysis results, optional visualization data, and generated code.
     """
-    df = DataService.get_session(request.session_id)
-    
-    if df is None:
+    if not DataService.has_session(request.session_id):
         raise HTTPException(
             status_code=404,
             detail=f"Session not found: {request.session_id}. Please upload a file first."
@@ -142,7 +151,37 @@ async def query_data(request: QueryRequest):
         include_code=request.include_code,
     )
     
-    return response
+    return ORJSONResponse(response.model_dump(mode="json"))
+
+
+@router.post("/query/stream")
+async def query_data_stream(request: QueryRequest):
+    """
+    Query data using natural language, streaming the result as Server-Sent Events.
+    
+    Emits `answer` and `code` events as soon as those fields are generated, then a
+    final `result` event with the same payload as `/query`.
+    """
+    if not DataService.has_session(request.session_id):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Session not found: {request.session_id}. Please upload a file first."
+        )
+    
+    if not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    
+    ai_service = get_ai_service()
+    
+    async def event_stream():
+        async for event, payload in ai_service.query_stream(
+            session_id=request.session_id,
+            user_query=request.query,
+            include_code=request.include_code,
+        ):
+            yield b"event: " + event.encode() + b"\ndata: " + orjson.dumps(payload) + b"\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 @router.delete("/session/{session_id}")
@@ -18,6 +18,11 @@ class Settings(BaseSettings):
     allowed_extensions: list[str] = [".csv", ".xlsx", ".xls", ".json", ".parquet", ".tsv"]
     upload_dir: str = "uploads"
     
+    # Sessions (least recently used are evicted from memory beyond this total
+    # size, and deleted from disk when unused for the retention period)
+    max_sessions_mem_mb: int = 1024
+    session_ttl_hours: int = 24
+    
     # AI Configuration
     anthropic_api_key: str = ""
     ai_model: str = "claude-sonnet-4-20250514"
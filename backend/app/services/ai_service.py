@@ -1,26 +1,29 @@
 import anthropic
+import anyio
+import asyncio
 import json
-import re
+import msgspec
 import time
-from typing import Any
+from typing import Any, AsyncIterator
 
 from ..config import get_settings
 from ..models import QueryResponse, ChartData, ChartType
 from .data_service import DataService
 
 
-class AIService:
-    """Service for AI-powered data analysis using Claude."""
-    
-    def __init__(self):
-        settings = get_settings()
-        self.client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
-        self.model = settings.ai_model
-        self.max_tokens = settings.max_tokens
-    
-    def _build_system_prompt(self, df_info: str, columns: list[str]) -> str:
-        """Build system prompt with data context."""
-        return f"""You are DataLens AI, an expert data analyst assistant. You help users analyze their data using natural language.
+class _AIReply(msgspec.Struct, kw_only=True):
+    """Expected structure of the JSON reply from Claude."""
+    answer: str = "Analysis complete."
+    code: str | None = None
+    # Left untyped so a malformed chart is dropped without losing answer and code
+    chart: Any = None
+
+
+_REPLY_DECODER = msgspec.json.Decoder(_AIReply)
+
+
+# Static system prompt; only the dataset context is substituted per query
+_SYSTEM_PROMPT_TEMPLATE = """You are DataLens AI, an expert data analyst assistant. You help users analyze their data using natural language.
 
 ## Your Capabilities
 - Answer questions about data using pandas
@@ -32,7 +35,7 @@ class AIService:
 {df_info}
 
 ## Available Columns
-{', '.join(columns)}
+{columns}
 
 ## Response Format
 Always respond with valid JSON in this exact structure:
@@ -65,6 +68,20 @@ Always respond with valid JSON in this exact structure:
 - Proportions → pie (only for <7 categories)
 """
 
+
+class AIService:
+    """Service for AI-powered data analysis using Claude."""
+    
+    def __init__(self):
+        settings = get_settings()
+        self.client = anthropic.AsyncAnthropic(api_key=settings.anthropic_api_key)
+        self.model = settings.ai_model
+        self.max_tokens = settings.max_tokens
+    
+    def _build_system_prompt(self, df_info: str, columns: list[str]) -> str:
+        """Build system prompt with data context."""
+        return _SYSTEM_PROMPT_TEMPLATE.format(df_info=df_info, columns=", ".join(columns))
+
     def _build_user_prompt(self, query: str, sample_data: str) -> str:
         """Build user prompt with query and sample data."""
         return f"""## Sample Data (first 3 rows)
@@ -75,120 +92,259 @@ Always respond with valid JSON in this exact structure:
 
 Analyze the data and respond with JSON only. No markdown formatting around the JSON."""
 
-    def _parse_response(self, response_text: str) -> dict[str, Any]:
+    def _parse_response(self, response_text: str) -> _AIReply:
         """Parse and validate AI response."""
         # Try to extract JSON from response
         text = response_text.strip()
         
         # Remove markdown code blocks if present
         if text.startswith("```"):
-            text = re.sub(r"^```(?:json)?\n?", "", text)
-            text = re.sub(r"\n?```$", "", text)
+            text = text.removeprefix("```").removeprefix("json").removeprefix("\n")
+            text = text.removesuffix("```").removesuffix("\n")
         
         try:
-            return json.loads(text)
-        except json.JSONDecodeError:
-            # Try to find JSON object in response
-            match = re.search(r'\{[\s\S]*\}', text)
-            if match:
+            return _REPLY_DECODER.decode(text)
+        except msgspec.DecodeError:
+            # Try to find JSON object in response, from the first "{" to the last "}"
+            start, end = text.find("{"), text.rfind("}")
+            if start != -1 and end > start:
                 try:
-                    return json.loads(match.group())
-                except json.JSONDecodeError:
+                    return _REPLY_DECODER.decode(text[start:end + 1])
+                except msgspec.DecodeError:
                     pass
             
             # Return basic response if parsing fails
-            return {
-                "answer": response_text,
-                "code": None,
-                "chart": None
-            }
+            return _AIReply(answer=response_text)
+    
+    def _build_request(self, context: tuple[str, list[str], str], user_query: str) -> dict[str, Any]:
+        """Build Claude API request arguments from session context."""
+        df_info, columns, sample_data = context
+        system_prompt = self._build_system_prompt(df_info, columns)
+        user_prompt = self._build_user_prompt(user_query, sample_data)
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {"role": "user", "content": user_prompt}
+            ],
+            # The system prompt is identical for every query on a session,
+            # so let Anthropic cache it
+            "system": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+        }
+    
+    async def _execute_code(self, session_id: str, code: str) -> tuple[list[Any] | None, str | None]:
+        """Execute generated code, returning (result data, error message)."""
+        try:
+            exec_result = await anyio.to_thread.run_sync(DataService.execute_pandas_code, session_id, code)
+        except Exception as e:
+            return None, str(e)
+        
+        if exec_result["type"] == "dataframe":
+            return exec_result["data"], None
+        elif exec_result["type"] in ["series", "collection"]:
+            return (exec_result["data"] if isinstance(exec_result["data"], list) else [exec_result["data"]]), None
+        return None, None
+    
+    def _build_response(
+        self,
+        parsed: _AIReply,
+        result_data: list[Any] | None,
+        exec_error: str | None,
+        include_code: bool,
+        start_time: float,
+    ) -> QueryResponse:
+        """Assemble the query response from the parsed reply and execution result."""
+        answer = parsed.answer
+        if exec_error:
+            answer += f"\n\n⚠️ Code execution note: {exec_error}"
+        
+        # Build chart data if present
+        chart = None
+        if isinstance(parsed.chart, dict):
+            chart_info = parsed.chart
+            try:
+                chart = ChartData(
+                    type=ChartType(chart_info.get("type", "bar")),
+                    title=chart_info.get("title", ""),
+                    data=chart_info.get("data", []),
+                    x_key=chart_info.get("x_key"),
+                    y_keys=chart_info.get("y_keys", []),
+                    config=chart_info.get("config", {})
+                )
+            except Exception:
+                pass  # Skip invalid chart data
+        
+        execution_time = (time.time() - start_time) * 1000
+        
+        return QueryResponse(
+            success=True,
+            answer=answer,
+            data=result_data,
+            chart=chart,
+            code=parsed.code if include_code else None,
+            execution_time_ms=round(execution_time, 2)
+        )
     
     async def query(self, session_id: str, user_query: str, include_code: bool = False) -> QueryResponse:
         """Process natural language query and return analysis."""
         start_time = time.time()
         
-        # Get session data
-        df = DataService.get_session(session_id)
-        if df is None:
-            return QueryResponse(
+        # Queries need the full dataset, not the upload preview
+        await anyio.to_thread.run_sync(DataService.materialize_session, session_id)
+        
+        # Get session context, cached per session (may reload it from disk)
+        context = await anyio.to_thread.run_sync(DataService.get_prompt_context, session_id)
+        if context is None:
+            return QueryResponse.model_construct(
                 success=False,
                 answer=f"Session not found: {session_id}. Please upload a file first.",
                 execution_time_ms=0
             )
         
-        # Build prompts
-        df_info = f"Shape: {df.shape[0]} rows × {df.shape[1]} columns\nTypes:\n{df.dtypes.to_string()}"
-        columns = df.columns.tolist()
-        sample_data = df.head(3).to_string()
-        
-        system_prompt = self._build_system_prompt(df_info, columns)
-        user_prompt = self._build_user_prompt(user_query, sample_data)
-        
         try:
             # Call Claude API
-            message = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ],
-                system=system_prompt
-            )
+            message = await self.client.messages.create(**self._build_request(context, user_query))
             
             response_text = message.content[0].text
             parsed = self._parse_response(response_text)
             
             # Execute code if present
-            result_data = None
-            if parsed.get("code"):
-                try:
-                    exec_result = DataService.execute_pandas_code(session_id, parsed["code"])
-                    if exec_result["type"] == "dataframe":
-                        result_data = exec_result["data"]
-                    elif exec_result["type"] in ["series", "collection"]:
-                        result_data = exec_result["data"] if isinstance(exec_result["data"], list) else [exec_result["data"]]
-                except Exception as e:
-                    parsed["answer"] += f"\n\n⚠️ Code execution note: {str(e)}"
-            
-            # Build chart data if present
-            chart = None
-            if parsed.get("chart"):
-                chart_info = parsed["chart"]
-                try:
-                    chart = ChartData(
-                        type=ChartType(chart_info.get("type", "bar")),
-                        title=chart_info.get("title", ""),
-                        data=chart_info.get("data", []),
-                        x_key=chart_info.get("x_key"),
-                        y_keys=chart_info.get("y_keys", []),
-                        config=chart_info.get("config", {})
-                    )
-                except Exception:
-                    pass  # Skip invalid chart data
+            result_data, exec_error = None, None
+            if parsed.code:
+                result_data, exec_error = await self._execute_code(session_id, parsed.code)
             
-            execution_time = (time.time() - start_time) * 1000
+            return self._build_response(parsed, result_data, exec_error, include_code, start_time)
             
-            return QueryResponse(
-                success=True,
-                answer=parsed.get("answer", "Analysis complete."),
-                data=result_data,
-                chart=chart,
-                code=parsed.get("code") if include_code else None,
-                execution_time_ms=round(execution_time, 2)
+        except anthropic.APIError as e:
+            return QueryResponse.model_construct(
+                success=False,
+                answer=f"AI service error: {str(e)}",
+                execution_time_ms=(time.time() - start_time) * 1000
+            )
+        except Exception as e:
+            return QueryResponse.model_construct(
+                success=False,
+                answer=f"Unexpected error: {str(e)}",
+                execution_time_ms=(time.time() - start_time) * 1000
+            )
+    
+    async def query_stream(
+        self, session_id: str, user_query: str, include_code: bool = False
+    ) -> AsyncIterator[tuple[str, dict[str, Any]]]:
+        """
+        Process natural language query, yielding (event, payload) pairs as the reply streams.
+        
+        Emits `answer` and `code` as soon as those fields are complete, starts executing
+        the code while the rest of the reply is still streaming, and finishes with a
+        `result` event carrying the full QueryResponse.
+        """
+        start_time = time.time()
+        
+        await anyio.to_thread.run_sync(DataService.materialize_session, session_id)
+        context = await anyio.to_thread.run_sync(DataService.get_prompt_context, session_id)
+        if context is None:
+            response = QueryResponse.model_construct(
+                success=False,
+                answer=f"Session not found: {session_id}. Please upload a file first.",
+                execution_time_ms=0
             )
+            yield "result", response.model_dump(mode="json")
+            return
+        
+        scanner = _FieldScanner()
+        exec_task: asyncio.Task | None = None
+        try:
+            async with self.client.messages.stream(**self._build_request(context, user_query)) as stream:
+                async for chunk in stream.text_stream:
+                    for key in scanner.feed(chunk):
+                        if key == "answer":
+                            yield "answer", {"answer": scanner.fields["answer"]}
+                        elif key == "code" and exec_task is None:
+                            exec_task = asyncio.create_task(self._execute_code(session_id, scanner.fields["code"]))
+                            if include_code:
+                                yield "code", {"code": scanner.fields["code"]}
+            
+            parsed = self._parse_response(scanner.text)
+            if exec_task is None and parsed.code:
+                exec_task = asyncio.create_task(self._execute_code(session_id, parsed.code))
+            result_data, exec_error = await exec_task if exec_task else (None, None)
+            response = self._build_response(parsed, result_data, exec_error, include_code, start_time)
             
         except anthropic.APIError as e:
-            return QueryResponse(
+            response = QueryResponse.model_construct(
                 success=False,
                 answer=f"AI service error: {str(e)}",
                 execution_time_ms=(time.time() - start_time) * 1000
             )
         except Exception as e:
-            return QueryResponse(
+            response = QueryResponse.model_construct(
                 success=False,
                 answer=f"Unexpected error: {str(e)}",
                 execution_time_ms=(time.time() - start_time) * 1000
             )
+        finally:
+            # The client may disconnect before the result is sent
+            if exec_task is not None and not exec_task.done():
+                exec_task.cancel()
+        
+        yield "result", response.model_dump(mode="json")
+
+
+class _FieldScanner:
+    """Incrementally extract top-level string fields from a streamed JSON object."""
+    
+    def __init__(self):
+        self.text = ""
+        self.fields: dict[str, str] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: str | None = None
+    
+    def feed(self, chunk: str) -> list[str]:
+        """Consume a chunk of text and return keys whose string values just completed."""
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        try:
+                            value = json.loads(text[self._string_start:i + 1])
+                        except ValueError:
+                            # Invalid escape; the final parse of the whole reply decides
+                            value = None
+                        if self._expect_key:
+                            self._key = value
+                            self._expect_key = False
+                        elif self._key is not None:
+                            if value is not None:
+                                self.fields[self._key] = value
+                                completed.append(self._key)
+                            self._key = None
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch in "{[":
+                self._depth += 1
+                self._expect_key = self._depth == 1
+            elif ch in "}]":
+                self._depth -= 1
+            elif ch == "," and self._depth == 1:
+                self._expect_key = True
+                self._key = None
+        self._pos = len(text)
+        return completed
 
 
 # Singleton instance
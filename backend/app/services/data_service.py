@@ -1,18 +1,97 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import anyio
+import ast
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from types import CodeType
 from typing import Any
 import json
 
+from ..config import get_settings
 from ..models import FileType, ColumnProfile, DataProfile
+from . import fast_stats
+
+
+# Threads used to profile columns in parallel; pandas releases the GIL in its C loops
+_PROFILE_WORKERS = min(8, os.cpu_count() or 1)
+
+# Uploads longer than this are profiled from a preview and fully loaded later
+_PREVIEW_ROWS = 500_000
+
+# pandas' default missing-value strings, so streamed CSV previews treat nulls
+# exactly like pd.read_csv
+_CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+
+# Attributes through which pandas and numpy expose other modules, e.g.
+# `pd.io.common.os`; with these and private names blocked, snippets cannot
+# reach os, sys or builtins from `pd` and `np`
+_BLOCKED_ATTRIBUTES = frozenset({
+    "builtins", "compat", "core", "ctypes", "ctypeslib", "f2py", "importlib", "inspect",
+    "io", "lib", "os", "pathlib", "pickle", "shutil", "subprocess", "sys", "tempfile",
+    "testing", "util",
+})
+
+
+class _CodeValidator(ast.NodeVisitor):
+    """Reject imports, private names and module-reaching attributes in AI-generated code."""
+    
+    def visit_Import(self, node: ast.Import) -> None:
+        raise ValueError("Imports are not allowed")
+    
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        raise ValueError("Imports are not allowed")
+    
+    def visit_Name(self, node: ast.Name) -> None:
+        if node.id.startswith("_"):
+            raise ValueError(f"Access to private name is not allowed: {node.id}")
+    
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if node.attr.startswith("_"):
+            raise ValueError(f"Access to private attribute is not allowed: {node.attr}")
+        if node.attr in _BLOCKED_ATTRIBUTES:
+            raise ValueError(f"Access to module attribute is not allowed: {node.attr}")
+        self.generic_visit(node)
+
+
+@lru_cache(maxsize=256)
+def _compile(code: str) -> CodeType:
+    """Validate and compile AI-generated code."""
+    tree = ast.parse(code, "<ai-query>", "exec")
+    _CodeValidator().visit(tree)
+    return compile(tree, "<ai-query>", "exec")
 
 
 class DataService:
     """Service for data loading, profiling, and manipulation."""
     
-    # In-memory storage for active sessions
-    _sessions: dict[str, pd.DataFrame] = {}
+    # Sessions are persisted as Parquet plus a JSON profile; these dicts are an
+    # in-memory cache ordered from least to most recently used and bounded by
+    # total DataFrame memory
+    _sessions: OrderedDict[str, pd.DataFrame] = OrderedDict()
     _metadata: dict[str, dict[str, Any]] = {}
+    _profiles: dict[str, DataProfile] = {}
+    # AI prompt context per session: (df_info, columns, sample_data)
+    _prompt_ctx: dict[str, tuple[str, list[str], str]] = {}
+    _session_bytes: dict[str, int] = {}
+    # Sessions currently holding a preview: source file, type and a load lock
+    _pending: dict[str, tuple[Path, FileType, threading.Lock]] = {}
+    _total_bytes: int = 0
+    # Guards session mutations made from worker threads
+    _lock = threading.Lock()
     
     @classmethod
     def detect_file_type(cls, filename: str) -> FileType:
@@ -31,77 +110,365 @@ class DataService:
         return mapping[ext]
     
     @classmethod
-    async def load_file(cls, file_path: Path, file_type: FileType) -> pd.DataFrame:
-        """Load data file into DataFrame."""
+    def _read_file(cls, file_path: Path, file_type: FileType) -> pd.DataFrame:
+        """Read a complete data file into an Arrow-backed DataFrame."""
+        # The pyarrow readers parse multi-threaded and keep strings in Arrow
+        # memory instead of Python objects
         loaders = {
-            FileType.CSV: lambda p: pd.read_csv(p),
-            FileType.TSV: lambda p: pd.read_csv(p, sep="\t"),
-            FileType.EXCEL: lambda p: pd.read_excel(p),
-            FileType.JSON: lambda p: pd.read_json(p),
-            FileType.PARQUET: lambda p: pd.read_parquet(p),
+            FileType.CSV: lambda p: pd.read_csv(p, engine="pyarrow", dtype_backend="pyarrow"),
+            FileType.TSV: lambda p: pd.read_csv(p, sep="\t", engine="pyarrow", dtype_backend="pyarrow"),
+            FileType.EXCEL: lambda p: pd.read_excel(p, dtype_backend="pyarrow"),
+            FileType.JSON: lambda p: pd.read_json(p, dtype_backend="pyarrow"),
+            FileType.PARQUET: lambda p: pd.read_parquet(p, engine="pyarrow", dtype_backend="pyarrow"),
         }
         
         loader = loaders.get(file_type)
         if not loader:
             raise ValueError(f"No loader for file type: {file_type}")
         
-        return loader(file_path)
+        return cls._dedupe_columns(loader(file_path))
+    
+    @classmethod
+    def _dedupe_columns(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """Rename duplicate columns to `name.1`, `name.2`, ... as pandas' C parser does."""
+        # Parquet cannot store duplicate names, and `df[name]` would be ambiguous
+        if df.columns.is_unique:
+            return df
+        names = list(df.columns)
+        existing = set(names)
+        counts: dict[Any, int] = {}
+        for i, name in enumerate(names):
+            count = counts.get(name, 0)
+            if count > 0:
+                new_name = f"{name}.{count}"
+                while new_name in existing:
+                    count += 1
+                    new_name = f"{name}.{count}"
+                names[i] = new_name
+                existing.add(new_name)
+            counts[name] = count + 1
+        return df.set_axis(names, axis=1)
+    
+    @classmethod
+    def _read_preview(cls, file_path: Path, file_type: FileType) -> tuple[pd.DataFrame, bool]:
+        """Read up to _PREVIEW_ROWS rows, returning (DataFrame, whether rows were left out)."""
+        if file_type in (FileType.CSV, FileType.TSV):
+            delimiter = "\t" if file_type == FileType.TSV else ","
+            batches = []
+            rows = 0
+            try:
+                reader = pa_csv.open_csv(
+                    file_path,
+                    read_options=pa_csv.ReadOptions(block_size=8 << 20),
+                    parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+                    convert_options=pa_csv.ConvertOptions(
+                        null_values=_CSV_NULL_VALUES,
+                        strings_can_be_null=True,
+                    ),
+                )
+                for batch in reader:
+                    batches.append(batch)
+                    rows += batch.num_rows
+                    if rows > _PREVIEW_ROWS:
+                        break
+            except pa.ArrowInvalid:
+                # Types inferred from the first block did not fit later rows
+                return cls._read_file(file_path, file_type), False
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            is_preview = rows > _PREVIEW_ROWS
+            if is_preview:
+                table = table.slice(0, _PREVIEW_ROWS)
+            return cls._dedupe_columns(table.to_pandas(types_mapper=pd.ArrowDtype)), is_preview
+        
+        if file_type == FileType.PARQUET:
+            parquet_file = pq.ParquetFile(file_path)
+            if parquet_file.metadata.num_rows > _PREVIEW_ROWS:
+                batch = next(parquet_file.iter_batches(batch_size=_PREVIEW_ROWS))
+                table = pa.Table.from_batches([batch])
+                return cls._dedupe_columns(table.to_pandas(types_mapper=pd.ArrowDtype)), True
+        
+        # Excel and JSON have no incremental reader
+        return cls._read_file(file_path, file_type), False
+    
+    @classmethod
+    async def load_preview(cls, file_path: Path, file_type: FileType) -> tuple[pd.DataFrame, bool]:
+        """Load the first rows of a data file, returning (DataFrame, is_preview)."""
+        # Parse in a worker thread so the event loop stays responsive
+        return await anyio.to_thread.run_sync(cls._read_preview, file_path, file_type)
+    
+    @classmethod
+    def _session_paths(cls, session_id: str) -> tuple[Path, Path] | None:
+        """Get Parquet and profile paths for a session, or None for invalid IDs."""
+        try:
+            # Session IDs come from URLs; only UUIDs may become file names
+            session_id = str(uuid.UUID(session_id))
+        except ValueError:
+            return None
+        session_dir = Path(get_settings().upload_dir)
+        return session_dir / f"{session_id}.session.parquet", session_dir / f"{session_id}.profile.json"
+    
+    @classmethod
+    def store_session(cls, session_id: str, df: pd.DataFrame, metadata: dict[str, Any]) -> DataProfile:
+        """Store DataFrame in session and cache its profile."""
+        # Session data is never mutated in place, so the profile stays valid
+        profile = cls.profile_dataframe(df, session_id, metadata["filename"], metadata["file_type"])
+        if metadata.get("preview"):
+            profile.warnings.insert(
+                0, f"Profile is based on the first {len(df):,} rows while the full file loads"
+            )
+        
+        paths = cls._session_paths(session_id)
+        if paths is not None:
+            data_path, profile_path = paths
+            try:
+                df.to_parquet(data_path, compression="zstd")
+                profile_path.write_text(profile.model_dump_json())
+            except (ValueError, TypeError, OSError, pa.ArrowException):
+                # Columns Arrow cannot encode, or an unwritable upload directory,
+                # keep the session in memory only
+                data_path.unlink(missing_ok=True)
+                profile_path.unlink(missing_ok=True)
+        
+        cls._cache_session(session_id, df, metadata, profile, int(profile.memory_usage_mb * 1024 * 1024))
+        return profile
+    
+    @classmethod
+    def defer_full_load(cls, session_id: str, file_path: Path, file_type: FileType) -> None:
+        """Record that a session holds a preview of the given file."""
+        with cls._lock:
+            cls._pending[session_id] = (file_path, file_type, threading.Lock())
+    
+    @classmethod
+    def materialize_session(cls, session_id: str) -> None:
+        """Replace a preview session with the full dataset, if it is still a preview."""
+        pending = cls._pending.get(session_id)
+        if pending is None:
+            return
+        file_path, file_type, load_lock = pending
+        
+        # Concurrent callers wait here for the first load to finish
+        with load_lock:
+            if session_id not in cls._pending:
+                return
+            metadata = cls.get_metadata(session_id)
+            if metadata is not None:
+                df = cls._read_file(file_path, file_type)
+                # delete_session drops the pending entry without waiting for the load
+                with cls._lock:
+                    deleted = session_id not in cls._pending
+                if not deleted:
+                    cls.store_session(session_id, df, {**metadata, "preview": False})
+            with cls._lock:
+                deleted = cls._pending.pop(session_id, None) is None
+            if deleted:
+                # Deleted while storing; remove whatever was just persisted
+                cls.delete_session(session_id)
+            file_path.unlink(missing_ok=True)
+    
+    @classmethod
+    def _cache_session(
+        cls,
+        session_id: str,
+        df: pd.DataFrame,
+        metadata: dict[str, Any],
+        profile: DataProfile,
+        size: int,
+    ) -> None:
+        """Add a session to the in-memory cache, evicting least recently used ones."""
+        max_bytes = get_settings().max_sessions_mem_mb * 1024 * 1024
+        with cls._lock:
+            cls._evict_session(session_id)
+            cls._sessions[session_id] = df
+            cls._metadata[session_id] = metadata
+            cls._profiles[session_id] = profile
+            cls._session_bytes[session_id] = size
+            cls._total_bytes += size
+            
+            # Evict least recently used sessions, always keeping the newest
+            while cls._total_bytes > max_bytes and len(cls._sessions) > 1:
+                cls._evict_session(next(iter(cls._sessions)))
     
     @classmethod
-    def store_session(cls, session_id: str, df: pd.DataFrame, metadata: dict[str, Any]) -> None:
-        """Store DataFrame in session."""
-        cls._sessions[session_id] = df
-        cls._metadata[session_id] = metadata
+    def _evict_session(cls, session_id: str) -> bool:
+        """Drop a session from the in-memory cache. Caller must hold the lock."""
+        if session_id not in cls._sessions:
+            return False
+        del cls._sessions[session_id]
+        del cls._metadata[session_id]
+        del cls._profiles[session_id]
+        cls._prompt_ctx.pop(session_id, None)
+        cls._total_bytes -= cls._session_bytes.pop(session_id)
+        return True
+    
+    @classmethod
+    def _load_session(cls, session_id: str) -> bool:
+        """Reload a persisted session into the in-memory cache."""
+        paths = cls._session_paths(session_id)
+        if paths is None or not paths[0].exists():
+            return False
+        data_path, profile_path = paths
+        try:
+            df = pd.read_parquet(data_path, engine="pyarrow", dtype_backend="pyarrow")
+            profile = DataProfile.model_validate_json(profile_path.read_text())
+        except FileNotFoundError:
+            # Deleted concurrently
+            return False
+        metadata = {"filename": profile.filename, "file_type": profile.file_type}
+        cls._cache_session(session_id, df, metadata, profile, int(df.memory_usage(deep=True).sum()))
+        return True
+    
+    @classmethod
+    def has_session(cls, session_id: str) -> bool:
+        """Check whether a session exists in memory or on disk."""
+        if session_id in cls._sessions:
+            return True
+        paths = cls._session_paths(session_id)
+        return paths is not None and paths[0].exists()
     
     @classmethod
     def get_session(cls, session_id: str) -> pd.DataFrame | None:
-        """Retrieve DataFrame from session."""
-        return cls._sessions.get(session_id)
+        """Retrieve DataFrame from session, marking it as recently used."""
+        with cls._lock:
+            df = cls._sessions.get(session_id)
+            if df is not None:
+                cls._sessions.move_to_end(session_id)
+        if df is None and cls._load_session(session_id):
+            df = cls._sessions.get(session_id)
+        if df is not None:
+            cls._touch_session(session_id)
+        return df
+    
+    @classmethod
+    def _touch_session(cls, session_id: str) -> None:
+        """Refresh the persisted session's mtime, which drives retention."""
+        paths = cls._session_paths(session_id)
+        if paths is not None:
+            try:
+                os.utime(paths[0])
+            except FileNotFoundError:
+                pass
+    
+    @classmethod
+    def purge_expired_sessions(cls) -> None:
+        """Delete sessions and leftover uploads not used within the retention period."""
+        settings = get_settings()
+        cutoff = time.time() - settings.session_ttl_hours * 3600
+        
+        # A session's last use is the newest mtime among its files
+        last_used: dict[str, float] = {}
+        for path in Path(settings.upload_dir).iterdir():
+            session_id = path.name.partition(".")[0]
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            last_used[session_id] = max(mtime, last_used.get(session_id, 0.0))
+        
+        for session_id, mtime in last_used.items():
+            # Only UUID-named files belong to sessions; pending uploads are still loading
+            if mtime >= cutoff or session_id in cls._pending or cls._session_paths(session_id) is None:
+                continue
+            cls.delete_session(session_id)
+            for path in Path(settings.upload_dir).glob(f"{session_id}.*"):
+                path.unlink(missing_ok=True)
     
     @classmethod
     def get_metadata(cls, session_id: str) -> dict[str, Any] | None:
         """Retrieve metadata from session."""
+        if session_id not in cls._metadata:
+            cls._load_session(session_id)
         return cls._metadata.get(session_id)
     
+    @classmethod
+    def get_prompt_context(cls, session_id: str) -> tuple[str, list[str], str] | None:
+        """Get (df_info, columns, sample_data) strings describing a session for the AI prompt."""
+        context = cls._prompt_ctx.get(session_id)
+        if context is not None:
+            cls._touch_session(session_id)
+            return context
+        
+        df = cls.get_session(session_id)
+        if df is None:
+            return None
+        context = (
+            f"Shape: {df.shape[0]} rows × {df.shape[1]} columns\nTypes:\n{df.dtypes.to_string()}",
+            df.columns.tolist(),
+            df.head(3).to_string(),
+        )
+        with cls._lock:
+            # Only cache while the session is still resident so eviction clears it
+            if session_id in cls._sessions:
+                cls._prompt_ctx[session_id] = context
+        return context
+    
+    @classmethod
+    def get_profile(cls, session_id: str) -> DataProfile | None:
+        """Retrieve cached profile from session."""
+        profile = cls._profiles.get(session_id)
+        if profile is None:
+            # Evicted sessions only need their profile, not the data
+            paths = cls._session_paths(session_id)
+            if paths is not None and paths[1].exists():
+                profile = DataProfile.model_validate_json(paths[1].read_text())
+        if profile is not None:
+            cls._touch_session(session_id)
+        return profile
+    
     @classmethod
     def delete_session(cls, session_id: str) -> bool:
-        """Delete session data."""
-        if session_id in cls._sessions:
-            del cls._sessions[session_id]
-            del cls._metadata[session_id]
-            return True
-        return False
+        """Delete session data from memory and disk."""
+        with cls._lock:
+            deleted = cls._evict_session(session_id)
+            pending = cls._pending.pop(session_id, None)
+        if pending is not None:
+            pending[0].unlink(missing_ok=True)
+        paths = cls._session_paths(session_id)
+        if paths is not None:
+            for path in paths:
+                if path.exists():
+                    path.unlink()
+                    deleted = True
+        return deleted
     
     @classmethod
-    def profile_column(cls, series: pd.Series, name: str) -> ColumnProfile:
+    def profile_column(cls, series: pd.Series, name: str, null_count: int | None = None) -> ColumnProfile:
         """Generate statistical profile for a column."""
-        non_null = series.notna().sum()
-        null_count = series.isna().sum()
         total = len(series)
+        if null_count is None:
+            null_count = int(series.isna().sum())
+        non_null = total - null_count
+        unique_count = int(series.nunique())
+        # Booleans count as numeric in pandas but have no meaningful quantiles
+        is_numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
         
-        profile = ColumnProfile(
+        # Built from computed values, so Pydantic validation is skipped
+        profile = ColumnProfile.model_construct(
             name=name,
             dtype=str(series.dtype),
-            non_null_count=int(non_null),
-            null_count=int(null_count),
+            non_null_count=non_null,
+            null_count=null_count,
             null_percentage=round(null_count / total * 100, 2) if total > 0 else 0,
-            unique_count=int(series.nunique()),
+            unique_count=unique_count,
         )
         
-        # Add numeric stats
-        if pd.api.types.is_numeric_dtype(series):
-            clean = series.dropna()
-            if len(clean) > 0:
-                profile.mean = round(float(clean.mean()), 4)
-                profile.std = round(float(clean.std()), 4)
-                profile.min = round(float(clean.min()), 4)
-                profile.max = round(float(clean.max()), 4)
-                profile.median = round(float(clean.median()), 4)
-                profile.q25 = round(float(clean.quantile(0.25)), 4)
-                profile.q75 = round(float(clean.quantile(0.75)), 4)
+        # Add numeric stats, computed in a single pass over the column with
+        # quartiles from one np.partition. Decimal columns are included via the
+        # float64 cast; Arrow's describe() cannot mix them with NumPy scalars.
+        desc = None
+        if is_numeric and non_null > 0:
+            desc = fast_stats.describe(series.to_numpy(dtype=np.float64, na_value=np.nan))
+        # Arrow null counts exclude NaN, so an all-NaN float column has no valid values
+        if desc is not None and desc["count"] > 0:
+            profile.mean = round(float(desc["mean"]), 4)
+            profile.std = round(float(desc["std"]), 4)
+            profile.min = round(float(desc["min"]), 4)
+            profile.max = round(float(desc["max"]), 4)
+            profile.median = round(float(desc["50%"]), 4)
+            profile.q25 = round(float(desc["25%"]), 4)
+            profile.q75 = round(float(desc["75%"]), 4)
         
         # Add categorical stats for non-numeric or low cardinality
-        if not pd.api.types.is_numeric_dtype(series) or series.nunique() < 20:
+        if not is_numeric or unique_count < 20:
             value_counts = series.value_counts().head(10)
             profile.top_values = [
                 {"value": str(v), "count": int(c), "percentage": round(c / total * 100, 2)}
@@ -110,6 +477,19 @@ class DataService:
         
         return profile
     
+    @classmethod
+    def _null_counts(cls, df: pd.DataFrame) -> list[int]:
+        """Count nulls per column without materializing a DataFrame-sized mask."""
+        counts = []
+        for i in range(len(df.columns)):
+            series = df.iloc[:, i]
+            if isinstance(series.dtype, pd.ArrowDtype):
+                # Arrow tracks the null count with the validity bitmap
+                counts.append(series.array.__arrow_array__().null_count)
+            else:
+                counts.append(int(series.isna().sum()))
+        return counts
+    
     @classmethod
     def profile_dataframe(
         cls, 
@@ -120,12 +500,19 @@ class DataService:
     ) -> DataProfile:
         """Generate complete profile for a DataFrame."""
         
+        # Null counts are computed once and shared with the column profiles
+        null_counts = cls._null_counts(df)
+        
         # Column profiles
-        columns = [cls.profile_column(df[col], col) for col in df.columns]
+        with ThreadPoolExecutor(max_workers=_PROFILE_WORKERS) as executor:
+            columns = list(executor.map(
+                lambda i: cls.profile_column(df.iloc[:, i], df.columns[i], null_counts[i]),
+                range(len(df.columns)),
+            ))
         
         # Calculate quality score
         total_cells = df.size
-        null_cells = df.isna().sum().sum()
+        null_cells = sum(null_counts)
         completeness = (1 - null_cells / total_cells) * 100 if total_cells > 0 else 100
         
         # Check for potential issues
@@ -135,21 +522,15 @@ class DataService:
                 warnings.append(f"Column '{col.name}' has {col.null_percentage}% missing values")
             if col.unique_count == 1:
                 warnings.append(f"Column '{col.name}' has only one unique value")
-            if col.unique_count == len(df) and col.dtype == "object":
+            if col.unique_count == len(df) and pd.api.types.is_string_dtype(df[col.name]):
                 warnings.append(f"Column '{col.name}' might be an ID column (all unique values)")
         
-        # Get sample data (first 5 rows)
-        sample = df.head(5).replace({np.nan: None}).to_dict(orient="records")
-        
-        # Serialize sample data properly
-        for row in sample:
-            for key, value in row.items():
-                if isinstance(value, (np.integer, np.floating)):
-                    row[key] = float(value) if isinstance(value, np.floating) else int(value)
-                elif pd.isna(value):
-                    row[key] = None
+        # Get sample data (first 5 rows); casting to object boxes values as
+        # native Python scalars and missing values become None in one pass
+        head = df.head(5)
+        sample = head.astype(object).where(head.notna(), None).to_dict(orient="records")
         
-        return DataProfile(
+        return DataProfile.model_construct(
             session_id=session_id,
             filename=filename,
             file_type=file_type,
@@ -169,11 +550,14 @@ class DataService:
         if df is None:
             raise ValueError(f"Session not found: {session_id}")
 
-        # Create a restricted execution environment
-        local_vars = {"df": df.copy(), "pd": pd, "np": np}
-
         try:
-            exec(code, {"__builtins__": {}}, local_vars)
+            compiled = _compile(code)
+
+            # Create a restricted execution environment. pandas 3 always uses
+            # Copy-on-Write, so a shallow copy is O(columns) and duplicates only
+            # the data written to.
+            local_vars = {"df": df.copy(deep=False), "pd": pd, "np": np}
+            exec(compiled, {"__builtins__": {}}, local_vars)
             result = local_vars.get("result")
 
             if isinstance(result, pd.DataFrame):
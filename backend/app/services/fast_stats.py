@@ -0,0 +1,49 @@
+import numpy as np
+from numba import njit
+
+
+QUANTILES = {"25%": 0.25, "50%": 0.5, "75%": 0.75}
+
+
+@njit(cache=True, nogil=True)
+def _stats(a: np.ndarray) -> tuple[int, float, float, float, float]:
+    """Single-pass Welford count/mean/std/min/max, skipping NaN."""
+    # No fastmath: it would let the compiler assume NaN never occurs
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    vmin = np.inf
+    vmax = -np.inf
+    for x in a:
+        if np.isnan(x):
+            continue
+        count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += (x - mean) * delta
+        if x < vmin:
+            vmin = x
+        if x > vmax:
+            vmax = x
+    std = np.sqrt(m2 / (count - 1)) if count > 1 else np.nan
+    return count, mean, std, vmin, vmax
+
+
+def describe(values: np.ndarray) -> dict[str, float]:
+    """Compute describe()-style statistics for a float array, ignoring NaN."""
+    count, mean, std, vmin, vmax = _stats(values)
+    if count == 0:
+        return {"count": 0, "mean": np.nan, "std": np.nan, "min": np.nan, "max": np.nan} | {
+            label: np.nan for label in QUANTILES
+        }
+    stats = {"count": count, "mean": mean, "std": std, "min": vmin, "max": vmax}
+    
+    # Linear interpolation between order statistics, as pandas does. NaN
+    # partitions to the end, so the first `count` slots hold the valid values.
+    positions = {label: q * (count - 1) for label, q in QUANTILES.items()}
+    kth = sorted({int(np.floor(p)) for p in positions.values()} | {int(np.ceil(p)) for p in positions.values()})
+    part = np.partition(values, kth)
+    for label, pos in positions.items():
+        lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+        stats[label] = part[lo] + (part[hi] - part[lo]) * (pos - lo)
+    return stats
@@ -0,0 +1,20 @@
+from collections import OrderedDict
+
+import pytest
+
+from app.config import get_settings
+from app.services import DataService
+
+
+@pytest.fixture(autouse=True)
+def isolated_sessions(tmp_path, monkeypatch):
+    """Give each test an empty session store backed by a temporary upload directory."""
+    monkeypatch.setattr(get_settings(), "upload_dir", str(tmp_path))
+    monkeypatch.setattr(DataService, "_sessions", OrderedDict())
+    monkeypatch.setattr(DataService, "_metadata", {})
+    monkeypatch.setattr(DataService, "_profiles", {})
+    monkeypatch.setattr(DataService, "_prompt_ctx", {})
+    monkeypatch.setattr(DataService, "_session_bytes", {})
+    monkeypatch.setattr(DataService, "_total_bytes", 0)
+    monkeypatch.setattr(DataService, "_pending", {})
+    return tmp_path
@@ -0,0 +1,100 @@
+import pytest
+
+from app.services import AIService, DataService
+from app.services.ai_service import _FieldScanner
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture
+def ai_service() -> AIService:
+    return AIService()
+
+
+@pytest.mark.parametrize("text", [
+    '{"answer": "Total is 6", "code": "result = 6"}',
+    '```json\n{"answer": "Total is 6", "code": "result = 6"}\n```',
+    'Here it is: {"answer": "Total is 6", "code": "result = 6"} Done.',
+])
+def test_parse_response_extracts_fields(ai_service, text):
+    parsed = ai_service._parse_response(text)
+    assert parsed.answer == "Total is 6"
+    assert parsed.code == "result = 6"
+
+
+def test_parse_response_falls_back_to_raw_text(ai_service):
+    parsed = ai_service._parse_response("I cannot answer that.")
+    assert parsed.answer == "I cannot answer that."
+    assert parsed.code is None
+
+
+@pytest.mark.parametrize("chart", ["false", '""', "[]", '{"type": "unknown"}'])
+def test_invalid_chart_keeps_answer_and_code(ai_service, chart):
+    parsed = ai_service._parse_response(f'{{"answer": "Total is 6", "code": "result = 6", "chart": {chart}}}')
+    assert parsed.answer == "Total is 6"
+    assert parsed.code == "result = 6"
+    
+    response = ai_service._build_response(parsed, None, None, include_code=True, start_time=0)
+    assert response.answer == "Total is 6"
+    assert response.chart is None
+
+
+def feed_in_chunks(text: str, size: int) -> tuple[_FieldScanner, list[str]]:
+    scanner = _FieldScanner()
+    completed = []
+    for i in range(0, len(text), size):
+        completed += scanner.feed(text[i:i + size])
+    return scanner, completed
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 1000])
+def test_field_scanner_handles_any_chunk_split(size):
+    text = '{"answer": "Say \\"hi\\"\\n\\u00e5", "code": "result = df[\\"a\\"]"}'
+    scanner, completed = feed_in_chunks(text, size)
+    assert completed == ["answer", "code"]
+    assert scanner.fields == {"answer": 'Say "hi"\nå', "code": 'result = df["a"]'}
+
+
+def test_field_scanner_ignores_nested_keys():
+    text = '{"chart": {"answer": "nested", "data": [{"code": "x"}]}, "answer": "top"}'
+    scanner, completed = feed_in_chunks(text, 1)
+    assert completed == ["answer"]
+    assert scanner.fields == {"answer": "top"}
+
+
+def test_field_scanner_skips_invalid_escapes():
+    text = '{"answer": "Rows with digits", "code": "result = df[df[\\"a\\"].str.contains(\\"\\d\\")]"}'
+    scanner, completed = feed_in_chunks(text, 4)
+    assert completed == ["answer"]
+    assert scanner.fields == {"answer": "Rows with digits"}
+
+
+@pytest.mark.anyio
+async def test_query_stream_falls_back_on_invalid_escape(ai_service, monkeypatch):
+    reply = '{"answer": "Rows with digits", "code": "result = df[\\"a\\"].str.contains(\\"\\d\\")"}'
+    
+    class Stream:
+        async def __aenter__(self):
+            return self
+        
+        async def __aexit__(self, *exc_info):
+            return False
+        
+        @property
+        async def text_stream(self):
+            for i in range(0, len(reply), 5):
+                yield reply[i:i + 5]
+    
+    monkeypatch.setattr(ai_service.client.messages, "stream", lambda **kwargs: Stream())
+    monkeypatch.setattr(DataService, "get_prompt_context", classmethod(lambda cls, session_id: ("", [], "")))
+    
+    events = [event async for event in ai_service.query_stream("session", "Which rows have digits?")]
+    
+    assert events[0] == ("answer", {"answer": "Rows with digits"})
+    event, result = events[-1]
+    assert event == "result"
+    assert result["success"]
+    assert result["answer"] == reply
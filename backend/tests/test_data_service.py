@@ -0,0 +1,227 @@
+import os
+import uuid
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from app.config import get_settings
+from app.models import FileType
+from app.services import DataService
+from app.services import data_service
+from app.services.data_service import _compile
+
+
+@pytest.fixture
+def session_id() -> str:
+    session_id = str(uuid.uuid4())
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    DataService.store_session(session_id, df, {"filename": "data.csv", "file_type": FileType.CSV})
+    return session_id
+
+
+@pytest.mark.parametrize("code", [
+    "import os",
+    "from os import path",
+    "result = __import__('os')",
+    "result = ().__class__",
+    "result = df._mgr",
+    "_x = 1",
+    "result = pd.io.common.os.getcwd()",
+    "result = np.lib.npyio.os.system('true')",
+    "result = np.ctypeslib.ctypes",
+    "result = pd.core.common.sys.modules",
+])
+def test_compile_rejects_imports_and_private_names(code):
+    with pytest.raises(ValueError):
+        _compile(code)
+
+
+@pytest.mark.parametrize("code", [
+    "result = df.groupby('a', as_index=False).sum()",
+    "result = df['a'].astype(str).str.upper()",
+    "result = np.random.default_rng(0).random(3)",
+    "result = pd.api.types.is_numeric_dtype(df['a'])",
+])
+def test_compile_accepts_pandas_code(code):
+    assert _compile(code) is _compile(code)
+
+
+def test_execute_pandas_code_returns_result(session_id):
+    assert DataService.execute_pandas_code(session_id, "result = df['a'].tolist()") == {
+        "type": "collection",
+        "data": [1, 2, 3],
+    }
+
+
+def test_execute_pandas_code_rejects_unsafe_code(session_id):
+    with pytest.raises(RuntimeError, match="Imports are not allowed"):
+        DataService.execute_pandas_code(session_id, "import os")
+    with pytest.raises(RuntimeError, match="module attribute is not allowed: os"):
+        DataService.execute_pandas_code(session_id, "result = pd.io.common.os.getcwd()")
+
+
+@pytest.mark.parametrize("code", [
+    "df['x'] = 1",
+    "df.loc[0, 'a'] = 9",
+    "df.insert(0, 'x', 1)",
+    "df.drop(columns=['a'], inplace=True)",
+    "(d := df); d['x'] = 1",
+    "d, e = df, 1; d['x'] = 1",
+    "def f(d):\n    d['x'] = 1\nf(df)",
+    "d = df if True else None; d['x'] = 1",
+    "for d in [df]:\n    d['x'] = 1",
+    "s = df['a']; s.iloc[0] = 9",
+])
+def test_execute_pandas_code_leaves_session_unchanged(session_id, code):
+    DataService.execute_pandas_code(session_id, code)
+    df = DataService.get_session(session_id)
+    assert df.columns.tolist() == ["a"]
+    assert df["a"].tolist() == [1, 2, 3]
+
+
+def test_read_file_renames_duplicate_columns(isolated_sessions):
+    path = isolated_sessions / "dupes.csv"
+    path.write_text("a,a,a.1,b,a\n1,2,3,4,5\n")
+    df = DataService._read_file(path, FileType.CSV)
+    assert df.columns.tolist() == ["a", "a.2", "a.1", "b", "a.3"]
+    
+    session_id = str(uuid.uuid4())
+    DataService.store_session(session_id, df, {"filename": "dupes.csv", "file_type": FileType.CSV})
+    assert (isolated_sessions / f"{session_id}.session.parquet").exists()
+
+
+def test_profile_decimal_column(isolated_sessions):
+    path = isolated_sessions / "prices.parquet"
+    table = pa.table({"price": pa.array([Decimal("1.25"), None, Decimal("3.50")], pa.decimal128(5, 2))})
+    pq.write_table(table, path)
+    df = DataService._read_file(path, FileType.PARQUET)
+    
+    profile = DataService.store_session(str(uuid.uuid4()), df, {"filename": "prices.parquet", "file_type": FileType.PARQUET})
+    column = profile.columns[0]
+    assert column.null_count == 1
+    assert (column.mean, column.min, column.median, column.max) == (2.375, 1.25, 2.375, 3.5)
+
+
+def test_profile_all_nan_arrow_column():
+    # NaN stored as a value, not as an Arrow null
+    df = pd.DataFrame({"x": pd.arrays.ArrowExtensionArray(pa.array([np.nan, np.nan]))})
+    column = DataService.profile_column(df["x"], "x", DataService._null_counts(df)[0])
+    assert column.null_count == 0
+    assert (column.mean, column.std, column.min, column.max, column.median) == (None,) * 5
+
+
+def test_store_session_keeps_session_in_memory_when_disk_fails(isolated_sessions, monkeypatch):
+    monkeypatch.setattr(get_settings(), "upload_dir", str(isolated_sessions / "missing"))
+    session_id = str(uuid.uuid4())
+    DataService.store_session(session_id, pd.DataFrame({"a": [1]}), {"filename": "data.csv", "file_type": FileType.CSV})
+    assert DataService.get_session(session_id)["a"].tolist() == [1]
+
+
+def test_session_cache_evicts_least_recently_used(isolated_sessions, monkeypatch):
+    # Each frame is ~0.8 MB, so two fit in the cache
+    monkeypatch.setattr(get_settings(), "max_sessions_mem_mb", 2)
+    frames = {str(uuid.uuid4()): pd.DataFrame({"a": np.arange(100_000) + i}) for i in range(3)}
+    first, second, third = frames
+    metadata = {"filename": "data.csv", "file_type": FileType.CSV}
+    
+    DataService.store_session(first, frames[first], metadata)
+    DataService.store_session(second, frames[second], metadata)
+    DataService.get_session(first)
+    DataService.store_session(third, frames[third], metadata)
+    assert list(DataService._sessions) == [first, third]
+    
+    # Evicted sessions reload from Parquet and push out the next least recently used
+    pd.testing.assert_frame_equal(DataService.get_session(second), frames[second], check_dtype=False)
+    assert list(DataService._sessions) == [third, second]
+    
+    # The newest session is kept even when it alone exceeds the limit
+    monkeypatch.setattr(get_settings(), "max_sessions_mem_mb", 0)
+    DataService.get_session(first)
+    assert list(DataService._sessions) == [first]
+    
+    for session_id in frames:
+        DataService.delete_session(session_id)
+    assert not DataService._sessions
+    assert DataService._total_bytes == 0
+
+
+def test_purge_expired_sessions(isolated_sessions, session_id):
+    stale_id = str(uuid.uuid4())
+    DataService.store_session(stale_id, pd.DataFrame({"a": [1]}), {"filename": "old.csv", "file_type": FileType.CSV})
+    leftover = isolated_sessions / f"{str(uuid.uuid4())}.csv"
+    leftover.write_text("a\n1\n")
+    for path in [*isolated_sessions.glob(f"{stale_id}.*"), leftover]:
+        os.utime(path, (0, 0))
+    
+    DataService.purge_expired_sessions()
+    
+    assert DataService.get_session(stale_id) is None
+    assert not list(isolated_sessions.glob(f"{stale_id}.*"))
+    assert not leftover.exists()
+    assert DataService.get_session(session_id) is not None
+
+
+@pytest.mark.parametrize("access", [
+    DataService.get_session,
+    DataService.get_profile,
+    DataService.get_prompt_context,
+])
+def test_access_postpones_expiry(isolated_sessions, session_id, access):
+    # The first access caches the prompt context, so the second one is a cache hit
+    access(session_id)
+    for path in isolated_sessions.glob(f"{session_id}.*"):
+        os.utime(path, (0, 0))
+    
+    access(session_id)
+    DataService.purge_expired_sessions()
+    
+    assert DataService.has_session(session_id)
+
+
+@pytest.mark.parametrize("file_type, text", [
+    (FileType.CSV, "a,b\n1,x\n2,y\n3,\n"),
+    (FileType.CSV, "a,b,c\n1,None,NA\n,<NA>,null\n3,z,4.5\n"),
+    (FileType.TSV, "a\tb\n1\tx\n\tN/A\n"),
+])
+def test_preview_matches_full_read(isolated_sessions, file_type, text):
+    path = isolated_sessions / "data.txt"
+    path.write_text(text)
+    preview, is_preview = DataService._read_preview(path, file_type)
+    assert not is_preview
+    pd.testing.assert_frame_equal(preview, DataService._read_file(path, file_type))
+
+
+def test_preview_truncates_large_files(isolated_sessions, monkeypatch):
+    monkeypatch.setattr(data_service, "_PREVIEW_ROWS", 10)
+    path = isolated_sessions / "data.csv"
+    path.write_text("a,b\n" + "".join(f"{i},\n" for i in range(100)))
+    preview, is_preview = DataService._read_preview(path, FileType.CSV)
+    assert is_preview
+    assert len(preview) == 10
+    assert preview["b"].isna().all()
+
+
+def test_delete_during_full_load_does_not_resurrect_session(isolated_sessions, monkeypatch):
+    session_id = str(uuid.uuid4())
+    path = isolated_sessions / f"{session_id}.csv"
+    path.write_text("a\n1\n2\n")
+    DataService.store_session(session_id, pd.DataFrame({"a": [1]}), {"filename": "data.csv", "file_type": FileType.CSV, "preview": True})
+    DataService.defer_full_load(session_id, path, FileType.CSV)
+    
+    read_file = DataService._read_file.__func__
+    
+    def read_then_delete(cls, file_path, file_type):
+        df = read_file(cls, file_path, file_type)
+        DataService.delete_session(session_id)
+        return df
+    
+    monkeypatch.setattr(DataService, "_read_file", classmethod(read_then_delete))
+    DataService.materialize_session(session_id)
+    
+    assert DataService.get_session(session_id) is None
+    assert DataService.get_profile(session_id) is None
+    assert not list(isolated_sessions.iterdir())
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services import fast_stats
+
+
+@pytest.mark.parametrize("values", [
+    [],
+    [np.nan, np.nan],
+    [1.0],
+    [3.0, 1.0],
+    [5.0, np.nan, 1.0, 2.0, np.nan, 4.0],
+    [2.0, 2.0, 2.0, 2.0],
+    np.random.default_rng(0).normal(size=1001),
+    np.random.default_rng(1).integers(-50, 50, size=100).astype(np.float64),
+])
+def test_describe_matches_pandas(values):
+    values = np.asarray(values, dtype=np.float64)
+    expected = pd.Series(values).describe()
+    stats = fast_stats.describe(values)
+    for label, value in expected.items():
+        assert stats[label] == pytest.approx(value, nan_ok=True), label